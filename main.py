@@ -1,15 +1,37 @@
 import os
+import asyncio
+import atexit
+import contextlib
+import hashlib
 import logging
-import requests
-from telegram import Update
+import queue
+import random
+import time
+import zipfile
+from collections import OrderedDict
+from datetime import timedelta
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+import numpy as np
+import orjson
+from telegram import Message, Update
+from telegram.error import BadRequest, RetryAfter, TelegramError
 from telegram.ext import Application, MessageHandler, filters, ContextTypes
 from telegram.constants import ParseMode
 
 # --- 1. Настройка Логирования ---
-# Помогает отслеживать ошибки на Render
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+# Помогает отслеживать ошибки на Render.
+# Запись в поток выполняется в фоновом потоке, чтобы не блокировать event loop
+log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 )
+log_listener = QueueListener(log_queue, log_stream_handler)
+# Форматирует только обработчик слушателя; QueueHandler передает сообщение как есть
+logging.basicConfig(handlers=[QueueHandler(log_queue)], format="%(message)s", level=logging.INFO)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # --- 2. Константы и Переменные Среды (Env Vars) ---
@@ -18,18 +40,373 @@ TELEGRAM_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
 OPENROUTER_KEY = os.environ.get("OPENROUTER_API_KEY")
 WEBHOOK_URL = os.environ.get("WEBHOOK_URL") 
 PORT = int(os.environ.get("PORT", 8080)) 
+# Сколько одновременных соединений Telegram может открыть к Webhook (максимум 100)
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", 100))
 
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_EMBEDDINGS_URL = "https://openrouter.ai/api/v1/embeddings"
 # Имя модели берется из переменной среды "MODEL"
 MODEL_NAME = os.environ.get("MODEL") 
+# Максимальная длина запроса пользователя (в символах)
+MAX_PROMPT_CHARS = int(os.environ.get("MAX_PROMPT_CHARS", "2000"))
+
+# Ограничение числа одновременных запросов к OpenRouter и повторы при 429
+LLM_SEM = asyncio.Semaphore(int(os.environ.get("LLM_CONCURRENCY", "8")))
+LLM_MAX_RETRIES = 3
+
+# Потоковый вывод: Telegram допускает примерно одно редактирование сообщения в секунду
+STREAM_EDIT_INTERVAL = 1.0
+STREAM_EDIT_MIN_CHARS = 200
+MAX_MESSAGE_LENGTH = 4096
 
 # СИСТЕМНЫЙ ПРОМПТ: Ключ к адекватности и таблицам
+# Текст должен оставаться неизменным (без дат и т.п.), иначе кэш промпта у провайдера не срабатывает
 SYSTEM_PROMPT = (
     "Ты — высококвалифицированный ИИ-агент по созданию документов и данных. "
     "Твоя задача — проанализировать запрос пользователя и создать готовый документ, текст или таблицу. "
     "Если пользователь описывает данные (списки, цифры, сравнения), сгенерируй таблицу, используя **строгий формат Markdown** (с вертикальными чертами \\| и дефисами -). "
     "Отвечай только сгенерированным контентом."
 )
+# Статичный системный промпт помечен для кэширования на стороне провайдера
+SYSTEM_MSG = {
+    "role": "system",
+    "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+}
+# Тексты сообщений пользователю
+MSG_GENERATING = "⏳ Запрос отправлен. Идет генерация документа..."
+MSG_NO_KEY = "Ошибка: Не настроен ключ OpenRouter API или имя модели."
+MSG_TOO_LONG = "Слишком длинный запрос."
+MSG_AI_ERROR = "Произошла ошибка при обращении к AI"
+MSG_UNKNOWN = "Произошла неизвестная ошибка. Попробуйте снова."
+
+HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_KEY}",
+    "Content-Type": "application/json",
+}
+
+# --- Кэш ответов (точное совпадение запроса) ---
+# Одинаковые запросы не отправляются повторно в OpenRouter
+CACHE_SIZE = 512
+CACHE_MAX_REQUEST_BYTES = 4096
+response_cache: "OrderedDict[bytes, str]" = OrderedDict()
+cache_lock = asyncio.Lock()
+
+def cache_key(user_request: str) -> bytes | None:
+    """Возвращает ключ кэша или None, если запрос слишком длинный для кэширования."""
+    encoded = user_request.encode()
+    if len(encoded) > CACHE_MAX_REQUEST_BYTES:
+        return None
+    return hashlib.blake2b(encoded, digest_size=16).digest()
+
+async def cache_get(key: bytes | None) -> str | None:
+    """Ищет ответ в кэше и помечает его как недавно использованный."""
+    if key is None:
+        return None
+    async with cache_lock:
+        cached = response_cache.get(key)
+        if cached is not None:
+            response_cache.move_to_end(key)
+        return cached
+
+async def cache_put(key: bytes | None, ai_response_text: str) -> None:
+    """Сохраняет ответ в кэше, вытесняя самые старые записи."""
+    if key is None:
+        return
+    async with cache_lock:
+        response_cache[key] = ai_response_text
+        response_cache.move_to_end(key)
+        while len(response_cache) > CACHE_SIZE:
+            response_cache.popitem(last=False)
+
+# --- Семантический кэш (похожие по смыслу запросы) ---
+# Перефразированные запросы находятся по косинусной близости эмбеддингов
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "openai/text-embedding-3-small")
+# Короткий таймаут: медленный эндпоинт эмбеддингов не должен задерживать генерацию
+EMBEDDING_TIMEOUT = 1.5
+# Эмбеддинги хранятся в .npz, ответы — в соседнем .json; если путь не задан — только в памяти
+SEMANTIC_CACHE_PATH = os.environ.get("SEMANTIC_CACHE_PATH")
+if SEMANTIC_CACHE_PATH and not SEMANTIC_CACHE_PATH.endswith(".npz"):
+    SEMANTIC_CACHE_PATH += ".npz"
+SEMANTIC_CACHE_SIZE = 5000
+SEMANTIC_THRESHOLD = 0.92
+SEMANTIC_SAVE_EVERY = 50
+
+class SemanticCache:
+    """Хранит нормированные эмбеддинги запросов и соответствующие ответы в кольцевом буфере."""
+
+    def __init__(self) -> None:
+        self.vectors: np.ndarray | None = None
+        self.answers: list[str | None] = [None] * SEMANTIC_CACHE_SIZE
+        self.count = 0
+        self.pos = 0
+        self.inserts_since_save = 0
+        self.lock = asyncio.Lock()
+        self.save_task: asyncio.Task | None = None
+
+    def reset(self, dim: int) -> None:
+        """Выделяет пустой буфер под эмбеддинги размерности dim."""
+        self.vectors = np.zeros((SEMANTIC_CACHE_SIZE, dim), dtype=np.float32)
+        self.answers = [None] * SEMANTIC_CACHE_SIZE
+        self.count = 0
+        self.pos = 0
+
+    def snapshot(self) -> tuple[np.ndarray, list[str]] | None:
+        """Возвращает копию записей в порядке от старых к новым."""
+        if self.vectors is None or self.count == 0:
+            return None
+        if self.count < SEMANTIC_CACHE_SIZE:
+            return self.vectors[:self.count].copy(), self.answers[:self.count]
+        order = np.r_[self.pos:SEMANTIC_CACHE_SIZE, 0:self.pos]
+        return self.vectors[order], self.answers[self.pos:] + self.answers[:self.pos]
+
+    def load(self, path: str) -> None:
+        """Загружает кэш с диска, если файлы существуют; поврежденный кэш пропускается."""
+        answers_path = path[:-len(".npz")] + ".json"
+        if not os.path.exists(path) or not os.path.exists(answers_path):
+            return
+        try:
+            with np.load(path, allow_pickle=False) as stored:
+                vectors = stored["vectors"]
+            with open(answers_path, "rb") as f:
+                answers = orjson.loads(f.read())
+            if not isinstance(answers, list) or vectors.ndim != 2 or len(answers) != vectors.shape[0]:
+                raise ValueError("эмбеддинги и ответы не согласованы")
+        except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            logger.warning(f"Семантический кэш не загружен, начинаем с пустого: {e}")
+            return
+        vectors = vectors[-SEMANTIC_CACHE_SIZE:]
+        answers = answers[-SEMANTIC_CACHE_SIZE:]
+        self.reset(vectors.shape[1])
+        self.count = len(answers)
+        self.pos = self.count % SEMANTIC_CACHE_SIZE
+        self.vectors[:self.count] = vectors
+        self.answers[:self.count] = answers
+        logger.info(f"Семантический кэш загружен: {self.count} записей")
+
+    @staticmethod
+    def save(path: str, snapshot: tuple[np.ndarray, list[str]] | None) -> None:
+        """Сохраняет снимок кэша на диск; каждый файл заменяется атомарно."""
+        if snapshot is None:
+            return
+        vectors, answers = snapshot
+        answers_path = path[:-len(".npz")] + ".json"
+        # Ответы пишутся первыми: при обрыве между заменами load() отбросит несогласованную пару
+        with open(answers_path + ".tmp", "wb") as f:
+            f.write(orjson.dumps(answers))
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, vectors=vectors)
+        os.replace(answers_path + ".tmp", answers_path)
+        os.replace(path + ".tmp", path)
+
+    def schedule_save(self, snapshot: tuple[np.ndarray, list[str]] | None) -> asyncio.Task:
+        """Запускает запись снимка в фоне; записи выполняются строго по очереди."""
+        previous = self.save_task
+
+        async def write() -> None:
+            if previous is not None:
+                await asyncio.wait([previous])
+            try:
+                await asyncio.to_thread(self.save, SEMANTIC_CACHE_PATH, snapshot)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось сохранить семантический кэш: {e}")
+
+        self.save_task = asyncio.create_task(write())
+        return self.save_task
+
+    async def search(self, vector: np.ndarray) -> str | None:
+        """Возвращает ответ ближайшего запроса, если сходство выше порога."""
+        async with self.lock:
+            if self.vectors is None or self.count == 0 or self.vectors.shape[1] != vector.shape[0]:
+                return None
+            scores = self.vectors[:self.count] @ vector
+            best = int(np.argmax(scores))
+            if scores[best] >= SEMANTIC_THRESHOLD:
+                return self.answers[best]
+            return None
+
+    async def add(self, vector: np.ndarray, ai_response_text: str) -> None:
+        """Добавляет запрос в кэш, перезаписывая самую старую запись."""
+        snapshot = None
+        async with self.lock:
+            if self.vectors is None or self.vectors.shape[1] != vector.shape[0]:
+                # Первая запись или сменилась модель эмбеддингов
+                self.reset(vector.shape[0])
+            self.vectors[self.pos] = vector
+            self.answers[self.pos] = ai_response_text
+            self.pos = (self.pos + 1) % SEMANTIC_CACHE_SIZE
+            self.count = min(self.count + 1, SEMANTIC_CACHE_SIZE)
+            self.inserts_since_save += 1
+            if SEMANTIC_CACHE_PATH and self.inserts_since_save >= SEMANTIC_SAVE_EVERY:
+                self.inserts_since_save = 0
+                snapshot = self.snapshot()
+        # Запись на диск — вне блокировки и в отдельном потоке
+        if snapshot is not None:
+            self.schedule_save(snapshot)
+
+semantic_cache = SemanticCache()
+
+async def embed(client: httpx.AsyncClient, text: str) -> np.ndarray:
+    """Получает нормированный эмбеддинг текста через OpenRouter."""
+    response = await client.post(
+        OPENROUTER_EMBEDDINGS_URL,
+        content=orjson.dumps({"model": EMBEDDING_MODEL, "input": text}),
+        timeout=EMBEDDING_TIMEOUT,
+    )
+    response.raise_for_status()
+    payload = orjson.loads(response.content)
+    vector = np.asarray(payload["data"][0]["embedding"], dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def log_prompt_cache_usage(usage: dict) -> None:
+    """Логирует использование кэша промпта у провайдера."""
+    cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    cache_read = usage.get("cache_read_input_tokens", cached_tokens)
+    cache_write = usage.get("cache_creation_input_tokens")
+    logger.info(
+        f"Токены промпта: {usage.get('prompt_tokens')}, "
+        f"из кэша: {cache_read}, записано в кэш: {cache_write}"
+    )
+
+async def read_stream(response: httpx.Response, on_text) -> tuple[str, dict]:
+    """Читает SSE-поток OpenRouter, передавая накопленные фрагменты текста в on_text."""
+    parts: list[str] = []
+    usage: dict = {}
+    async for line in response.aiter_lines():
+        # Пустые строки и комментарии (": OPENROUTER PROCESSING") пропускаем
+        if not line.startswith("data:"):
+            continue
+        chunk = line[len("data:"):].strip()
+        if chunk == "[DONE]":
+            break
+        event = orjson.loads(chunk)
+        if "error" in event:
+            raise RuntimeError(f"Ошибка генерации: {event['error']}")
+        usage = event.get("usage") or usage
+        for choice in event.get("choices", []):
+            delta = (choice.get("delta") or {}).get("content")
+            if delta:
+                parts.append(delta)
+                await on_text(parts)
+    return "".join(parts), usage
+
+async def stream_completion(client: httpx.AsyncClient, data: dict, on_text) -> tuple[str, dict]:
+    """Отправляет потоковый запрос к OpenRouter, повторяя его при превышении лимита (429)."""
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        async with LLM_SEM:
+            async with client.stream(
+                "POST", OPENROUTER_URL, content=orjson.dumps(data)
+            ) as response:
+                if response.status_code != 429 or attempt == LLM_MAX_RETRIES:
+                    response.raise_for_status()
+                    return await read_stream(response, on_text)
+                retry_after = response.headers.get("Retry-After")
+        # Ждем вне семафора, чтобы не занимать слот
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = 2 ** attempt
+        delay += random.uniform(0, 2 ** attempt)
+        logger.warning(f"OpenRouter вернул 429, повтор через {delay:.1f} с")
+        await asyncio.sleep(delay)
+
+async def with_retry_after(call):
+    """Выполняет вызов Telegram API, повторяя его один раз при RetryAfter."""
+    try:
+        return await call()
+    except RetryAfter as e:
+        delay = e.retry_after
+        if isinstance(delay, timedelta):
+            delay = delay.total_seconds()
+        logger.warning(f"Telegram RetryAfter, повтор через {delay} с")
+        await asyncio.sleep(delay)
+        return await call()
+
+async def reply(update: Update, text: str, **kwargs) -> Message:
+    """Отправляет ответ в Telegram, повторяя его один раз при RetryAfter."""
+    return await with_retry_after(lambda: update.message.reply_text(text, **kwargs))
+
+async def send_markdown(send, text: str) -> None:
+    """Отправляет текст с MarkdownV2, а при ошибке разметки — без форматирования (без повторной генерации)."""
+    try:
+        await send(text, parse_mode=ParseMode.MARKDOWN_V2)
+    except BadRequest as e:
+        if "can't parse entities" not in str(e).lower():
+            raise
+        logger.warning(f"Некорректная разметка MarkdownV2, ответ отправлен без форматирования: {e}")
+        await send(text)
+
+def split_message(text: str) -> list[str]:
+    """Делит текст на части не длиннее MAX_MESSAGE_LENGTH, по возможности по переводам строк."""
+    chunks = []
+    while len(text) > MAX_MESSAGE_LENGTH:
+        cut = text.rfind("\n", 0, MAX_MESSAGE_LENGTH)
+        if cut <= 0:
+            cut = MAX_MESSAGE_LENGTH
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
+
+async def reply_markdown(update: Update, text: str) -> None:
+    """Отправляет ответ с MarkdownV2 и запасным вариантом без разметки, разбивая длинный текст."""
+    for chunk in split_message(text):
+        await send_markdown(lambda t, **kwargs: reply(update, t, **kwargs), chunk)
+
+async def edit_message(message: Message, text: str, **kwargs) -> None:
+    """Редактирует сообщение; если текст уже совпадает, это не ошибка."""
+    try:
+        await with_retry_after(lambda: message.edit_text(text, **kwargs))
+    except BadRequest as e:
+        if "message is not modified" not in str(e).lower():
+            raise
+
+async def send_notice(update: Update, text: str) -> Message | None:
+    """Отправляет служебное уведомление; ошибки игнорируются, т.к. оно не влияет на результат."""
+    with contextlib.suppress(Exception):
+        return await reply(update, text)
+    return None
+
+class StreamingReply:
+    """Постепенно обновляет сообщение-заглушку по мере генерации ответа."""
+
+    def __init__(self, update: Update, placeholder_task: "asyncio.Task[Message | None]") -> None:
+        self.update = update
+        self.placeholder_task = placeholder_task
+        self.last_edit = 0.0
+        self.last_length = 0
+
+    async def on_text(self, parts: list[str]) -> None:
+        """Обновляет сообщение не чаще раза в STREAM_EDIT_INTERVAL секунд."""
+        # Пока заглушка не отправлена, редактировать нечего
+        if not self.placeholder_task.done():
+            return
+        message = self.placeholder_task.result()
+        now = time.monotonic()
+        if message is None or now - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        # Черновик показывает только первую часть ответа; дальше редактировать нечего
+        if self.last_length >= MAX_MESSAGE_LENGTH:
+            return
+        text = "".join(parts)
+        if len(text) - self.last_length < STREAM_EDIT_MIN_CHARS:
+            return
+        self.last_edit = now
+        self.last_length = len(text)
+        # Промежуточный текст отправляется без разметки: он может быть обрезан посреди сущности
+        with contextlib.suppress(TelegramError):
+            await message.edit_text(text[:MAX_MESSAGE_LENGTH])
+
+    async def finish(self, text: str) -> None:
+        """Заменяет заглушку итоговым ответом в MarkdownV2 (или отправляет его отдельно)."""
+        message = await self.placeholder_task
+        if message is None:
+            await reply_markdown(self.update, text)
+            return
+        # Первая часть заменяет заглушку, остальное отправляется следующими сообщениями
+        first, *rest = split_message(text)
+        await send_markdown(lambda t, **kwargs: edit_message(message, t, **kwargs), first)
+        for chunk in rest:
+            await send_markdown(lambda t, **kwargs: reply(self.update, t, **kwargs), chunk)
 
 # --- 3. Главный Обработчик Сообщений ---
 async def generate_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -38,56 +415,113 @@ async def generate_document(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     # Проверка, что все ключи настроены
     if not OPENROUTER_KEY or not MODEL_NAME:
-        await update.message.reply_text("Ошибка: Не настроен ключ OpenRouter API или имя модели.")
+        await reply(update, MSG_NO_KEY)
+        return
+
+    # Пустые и слишком длинные запросы отклоняются до обращения к OpenRouter
+    if not user_request or not user_request.strip():
+        return
+    if len(user_request) > MAX_PROMPT_CHARS:
+        await reply(update, MSG_TOO_LONG)
+        return
+
+    # Ответ из кэша: без обращения к OpenRouter
+    key = cache_key(user_request)
+    cached = await cache_get(key)
+    if cached is not None:
+        await reply_markdown(update, cached)
         return
 
-    # Уведомление пользователя
-    await update.message.reply_text("⏳ Запрос отправлен. Идет генерация документа...")
+    # Уведомление пользователя отправляется параллельно с поиском в семантическом кэше
+    # и запросом к OpenRouter; затем это сообщение редактируется по мере генерации ответа
+    notify_task = asyncio.create_task(send_notice(update, MSG_GENERATING))
+    streaming_reply = StreamingReply(update, notify_task)
+
+    # Поиск похожего запроса в семантическом кэше (ошибка эмбеддинга не мешает генерации)
+    client = context.application.bot_data["http"]
+    vector = None
+    try:
+        vector = await embed(client, user_request)
+        cached = await semantic_cache.search(vector)
+    except (httpx.HTTPError, KeyError, IndexError, ValueError) as e:
+        logger.warning(f"Семантический кэш недоступен: {e}")
+        cached = None
+    if cached is not None:
+        await streaming_reply.finish(cached)
+        await cache_put(key, cached)
+        return
 
     try:
         data = {
             "model": MODEL_NAME, # Используем переменную среды
-            "messages": [
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": user_request}
-            ]
-        }
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_KEY}",
-            "Content-Type": "application/json"
+            "messages": [SYSTEM_MSG, {"role": "user", "content": user_request}],
+            "stream": True,
         }
+        # Выполнение потокового запроса к OpenRouter (асинхронно, не блокируя event loop)
+        ai_response_text, usage = await stream_completion(client, data, streaming_reply.on_text)
+        log_prompt_cache_usage(usage)
 
-        # Выполнение запроса к OpenRouter
-        response = requests.post(OPENROUTER_URL, headers=headers, json=data, timeout=60)
-        response.raise_for_status()
-
-        # Извлечение сгенерированного текста
-        ai_response_text = response.json()["choices"][0]["message"]["content"]
-        
-        # Отправка ответа в Telegram с поддержкой MarkdownV2 для форматирования таблиц
+        # Итоговый ответ в Telegram с поддержкой MarkdownV2 для форматирования таблиц
         # (обратите внимание, что мы использовали двойной слэш \\| в SYSTEM_PROMPT для корректного отображения MarkdownV2)
-        await update.message.reply_text(
-            ai_response_text,
-            parse_mode=ParseMode.MARKDOWN_V2 
-        )
+        await streaming_reply.finish(ai_response_text)
+        # Кэшируем только успешно отправленные ответы
+        await cache_put(key, ai_response_text)
+        if vector is not None:
+            await semantic_cache.add(vector, ai_response_text)
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(f"Ошибка запроса к OpenRouter: {e}")
-        await update.message.reply_text(f"Произошла ошибка при обращении к AI: {e}")
+        await notify_task
+        await reply(update, f"{MSG_AI_ERROR}: {e}")
     except Exception as e:
         logger.error(f"Неизвестная ошибка: {e}")
-        await update.message.reply_text("Произошла неизвестная ошибка. Попробуйте снова.")
+        await notify_task
+        await reply(update, MSG_UNKNOWN)
+
+# --- 4. HTTP-клиент для OpenRouter ---
+async def post_init(application: Application) -> None:
+    """Создает общий HTTP-клиент для запросов к OpenRouter и загружает кэш."""
+    if SEMANTIC_CACHE_PATH:
+        semantic_cache.load(SEMANTIC_CACHE_PATH)
+    # HTTP/2: параллельные запросы мультиплексируются в одном keep-alive TLS-соединении
+    application.bot_data["http"] = httpx.AsyncClient(
+        http2=True,
+        headers=HEADERS,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+        timeout=60.0,
+    )
+
+async def post_shutdown(application: Application) -> None:
+    """Сохраняет кэш и закрывает HTTP-клиент при остановке бота."""
+    if SEMANTIC_CACHE_PATH:
+        await semantic_cache.schedule_save(semantic_cache.snapshot())
+    client = application.bot_data.pop("http", None)
+    if client is not None:
+        await client.aclose()
 
-# --- 4. Запуск Бота (Режим Webhook для Render) ---
+# --- 5. Запуск Бота (Режим Webhook для Render) ---
 def main() -> None:
     """Запускает бота в режиме Webhook для Render."""
     
+    # uvloop ускоряет сетевой ввод-вывод; на платформах без него используется стандартный цикл
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        logger.info("uvloop не установлен, используется стандартный event loop")
+
     if not TELEGRAM_TOKEN or not WEBHOOK_URL:
         logger.error("Ключи или WEBHOOK_URL не настроены. Бот не может быть запущен.")
         return
 
     # Создание экземпляра приложения (переменная 'application' используется Gunicorn)
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Добавление обработчика для всех текстовых сообщений
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, generate_document))
@@ -97,7 +531,10 @@ def main() -> None:
         listen="0.0.0.0",
         port=PORT,
         url_path=TELEGRAM_TOKEN,
-        webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}"
+        webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}",
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        # Бот обрабатывает только сообщения — остальные типы обновлений не нужны
+        allowed_updates=[Update.MESSAGE],
     )
     logger.info(f"Бот запущен на порту {PORT} с Webhook")
 